@@ -0,0 +1,214 @@
+"""
+Benchmark de detección de panel de LabFluxHPH.
+
+Extrae una vez el texto de cada página de los PDFs indicados (archivos o carpetas) y compara
+la detección actual (detect_panel_regions: un patrón combinado, encabezado primero) con la
+detección anterior (cada regex de SECTION_MARKERS con re.I sobre la página completa).
+Reporta coincidencia con la detección anterior (las páginas mixtas cuentan como diferencia,
+con cuántas líneas cambian de panel), ejemplos de diferencias y páginas/segundo de ambas.
+El texto extraído se puede guardar (--texts) para repetir la medición sin volver a pasar
+por pdfplumber. Antes de medir verifica los casos de REGRESSION_CASES (--check: solo eso).
+
+    python bench_panels.py corpus/ --repeat 20 --out panels.json
+    python bench_panels.py --texts corpus_texts.json --repeat 50
+    python bench_panels.py --check
+"""
+import argparse, json, os, re, sys, time
+
+import pdfplumber
+
+import main
+
+def legacy_detect_panel_page(text: str, profile: main.AliasProfile = main.DEFAULT_PROFILE) -> str:
+    """Detección anterior, como referencia: primer panel con algún marcador en la página."""
+    for panel, pats in profile.section_markers.items():
+        for pat in pats:
+            if re.search(pat, text, re.I):
+                return panel
+    return main.detect_panel_by_keywords(text.lower(), profile)
+
+def line_panels(text: str, regions: list[tuple[int, str]]) -> list[str]:
+    """Panel de cada línea según las regiones, como lo asigna parse_pdf."""
+    panels, region = [], 0
+    for line_no, _ in enumerate(text.split("\n")):
+        while region + 1 < len(regions) and regions[region + 1][0] <= line_no:
+            region += 1
+        panels.append(regions[region][1])
+    return panels
+
+_HEADER = [
+    "HOSPITAL PADRE HURTADO", "Paciente: PRUEBA", "RUT: 1-9", "Edad: 40", "Sexo: F",
+    "Médico: X", "Servicio: URGENCIA", "Fecha Recepción: 01/02/2024 10:30", "Procedencia: URG",
+]
+
+# (descripción, líneas de la página, regiones esperadas, {nombre: std esperado})
+REGRESSION_CASES = [
+    ("OC con urocultivo mencionado en una observación",
+     _HEADER + ["ORINA COMPLETA", "Observacion: se sugiere urocultivo", "LEUCOCITOS: 25", "PH: 6",
+                "BACTERIAS: Escasas"],
+     [(0, "oc")], {"LEUCOCITOS": "leucosoc", "PH": "phoc", "BACTERIAS": "bactoc"}),
+    ("OC con ORINA COMPLETA y UROCULTIVO listados en el encabezado",
+     ["ORINA COMPLETA", "UROCULTIVO"] + _HEADER + ["LEUCOCITOS: 25", "PH: 6", "BACTERIAS: Escasas"],
+     [(0, "oc")], {"LEUCOCITOS": "leucosoc", "PH": "phoc", "BACTERIAS": "bactoc"}),
+    ("OC y urocultivo con título propio cada uno",
+     _HEADER + ["ORINA COMPLETA", "LEUCOCITOS: 25", "PH: 6", "", "UROCULTIVO", "RECUENTO: >100000"],
+     [(0, "oc"), (13, "cultivo")], {"LEUCOCITOS": "leucosoc", "PH": "phoc"}),
+    # encabezado de 8 líneas: solo el marcador de la solicitud cae en PANEL_HEADER_LINES
+    ("Urocultivo solicitado en el encabezado sobre una sección OC",
+     _HEADER[:3] + ["Solicitud: UROCULTIVO"] + _HEADER[3:7] + ["ORINA COMPLETA", "LEUCOCITOS: 25",
+                                                            "PH: 6", "GLUCOSA: Negativo"],
+     [(0, "oc")], {"LEUCOCITOS": "leucosoc", "PH": "phoc", "GLUCOSA": "glucosaoc"}),
+    # encabezado corto: el primer título cae dentro de PANEL_HEADER_LINES
+    ("OC y urocultivo con título propio, el primero dentro del encabezado",
+     _HEADER[:3] + ["ORINA COMPLETA", "LEUCOCITOS: 25", "PH: 6", "BACTERIAS: Escasas", "", "",
+                    "", "UROCULTIVO", "RECUENTO: >100000"],
+     [(0, "oc"), (10, "cultivo")], {"LEUCOCITOS": "leucosoc", "PH": "phoc", "BACTERIAS": "bactoc"}),
+]
+
+def check_regressions() -> list[str]:
+    """Errores de los casos de REGRESSION_CASES (lista vacía si todos pasan)."""
+    errors = []
+    for desc, lines, expected_regions, expected_std in REGRESSION_CASES:
+        text = "\n".join(lines)
+        regions = main.detect_panel_regions(text)
+        if regions != expected_regions:
+            errors.append(f"{desc}: regiones {regions}, se esperaba {expected_regions}")
+            continue
+        for line, panel in zip(lines, line_panels(text, regions)):
+            name = line.split(":", 1)[0].strip()
+            if name in expected_std and main.coalesce_alias(name, panel) != expected_std[name]:
+                errors.append(f"{desc}: {name} -> {main.coalesce_alias(name, panel)} ({panel}), "
+                              f"se esperaba {expected_std[name]}")
+    return errors
+
+def iter_pdfs(paths: list[str]):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                for name in sorted(names):
+                    if name.lower().endswith(".pdf"):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+def extract_texts(paths: list[str]) -> list[dict]:
+    """Texto de cada página no vacía, con su origen."""
+    pages = []
+    for pdf_path in iter_pdfs(paths):
+        try:
+            with pdfplumber.open(pdf_path) as pdf:
+                for page_index, page in enumerate(pdf.pages):
+                    text = page.extract_text() or ""
+                    page.close()
+                    if text.strip():
+                        pages.append({"pdf": pdf_path, "page": page_index, "text": text})
+        except Exception as e:
+            print(f"omitido {pdf_path}: {e}", file=sys.stderr)
+    return pages
+
+def pages_per_second(fn, texts: list[str], repeat: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            fn(text)
+    elapsed = time.perf_counter() - t0
+    return len(texts) * repeat / elapsed if elapsed else float("inf")
+
+def compare(pages: list[dict], examples: int) -> dict:
+    """
+    Coincidencia de la detección actual con la anterior, página por página. Una página mixta
+    (varias regiones) difiere de la anterior por definición: cuenta como diferencia y se
+    reporta cuántas de sus líneas con texto cambian de panel.
+    """
+    profiles = main.get_alias_profiles()
+    agree, disagree, mixed, lines_changed, diffs = 0, 0, 0, 0, []
+    by_panel = {}
+    for p in pages:
+        profile = profiles.select(p["text"])
+        old = legacy_detect_panel_page(p["text"], profile)
+        regions = main.detect_panel_regions(p["text"], profile)
+        counts = by_panel.setdefault(old, {"pages": 0, "agree": 0})
+        counts["pages"] += 1
+        if len(regions) == 1 and regions[0][1] == old:
+            agree += 1
+            counts["agree"] += 1
+            continue
+        disagree += 1
+        changed = sum(
+            1 for line, panel in zip(p["text"].split("\n"), line_panels(p["text"], regions))
+            if line.strip() and panel != old
+        )
+        if len(regions) > 1:
+            mixed += 1
+            lines_changed += changed
+        if len(diffs) < examples:
+            header = "\n".join(p["text"].splitlines()[:main.PANEL_HEADER_LINES])
+            diffs.append({"pdf": p["pdf"], "page": p["page"], "old": old, "new": regions,
+                          "lines_changed": changed, "header": header})
+    return {
+        "pages": len(pages),
+        "mixed_pages": mixed,
+        "mixed_lines_changed": lines_changed,
+        "agree": agree,
+        "disagree": disagree,
+        "precision": agree / len(pages) if pages else None,
+        "by_legacy_panel": by_panel,
+        "examples": diffs,
+    }
+
+def main_cli():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("paths", nargs="*", help="PDFs o carpetas con PDFs")
+    ap.add_argument("--texts", help="JSON con textos ya extraídos; si no existe y hay PDFs, se guarda ahí")
+    ap.add_argument("--repeat", type=int, default=10, help="pasadas sobre el corpus para medir páginas/s")
+    ap.add_argument("--examples", type=int, default=10, help="máximo de diferencias a mostrar")
+    ap.add_argument("--out", help="guardar el resultado en JSON")
+    ap.add_argument("--check", action="store_true", help="solo verificar REGRESSION_CASES")
+    args = ap.parse_args()
+
+    errors = check_regressions()
+    for error in errors:
+        print(f"REGRESIÓN: {error}", file=sys.stderr)
+    if errors:
+        sys.exit(1)
+    if args.check:
+        print(f"{len(REGRESSION_CASES)} casos de regresión OK")
+        return
+
+    if args.texts and os.path.exists(args.texts) and not args.paths:
+        with open(args.texts, encoding="utf-8") as fh:
+            pages = json.load(fh)
+    else:
+        if not args.paths:
+            ap.error("indica PDFs/carpetas o un --texts existente")
+        pages = extract_texts(args.paths)
+        if args.texts:
+            with open(args.texts, "w", encoding="utf-8") as fh:
+                json.dump(pages, fh, ensure_ascii=False)
+    if not pages:
+        sys.exit("sin páginas con texto")
+
+    result = compare(pages, args.examples)
+    texts = [p["text"] for p in pages]
+    profile = main.DEFAULT_PROFILE
+    result["legacy_pages_per_s"] = pages_per_second(lambda t: legacy_detect_panel_page(t, profile), texts, args.repeat)
+    result["pages_per_s"] = pages_per_second(lambda t: main.detect_panel_regions(t, profile), texts, args.repeat)
+    result["speedup"] = result["pages_per_s"] / result["legacy_pages_per_s"]
+
+    print(f"páginas: {result['pages']} (mixtas: {result['mixed_pages']}, "
+          f"{result['mixed_lines_changed']} líneas con otro panel)")
+    print(f"coincidencia con detección anterior: {result['agree']}/{result['pages']} "
+          f"({result['precision']:.2%})")
+    for panel, c in sorted(result["by_legacy_panel"].items()):
+        print(f"  {panel:8s} {c['agree']}/{c['pages']}")
+    print(f"páginas/s: anterior {result['legacy_pages_per_s']:.0f}, actual {result['pages_per_s']:.0f} "
+          f"(x{result['speedup']:.1f})")
+    for d in result["examples"]:
+        print(f"\n{d['pdf']} p{d['page']}: {d['old']} -> {d['new']} "
+              f"({d['lines_changed']} líneas)\n{d['header']}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fh:
+            json.dump(result, fh, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,366 @@
+"""
+Prueba de carga de LabFluxHPH.
+
+Levanta la app con uvicorn en local (o apunta a --url), envía a /generate, /generate_json
+y /health una mezcla configurable de uploads sintéticos (PDF único, varios PDFs, ZIP grande),
+con concurrencia fija (--concurrency) o tasa de llegada (--rate), y reporta latencias
+p50/p95/p99, throughput, tasa de error y RSS del servidor en el tiempo. El resultado se
+guarda en JSON (--out) para comparar corridas con distinta cantidad de workers o settings.
+
+Requiere httpx (pip install httpx). Ejemplos:
+
+    python loadtest.py --concurrency 8 --duration 60 --workers 2 --out c8_w2.json
+    python loadtest.py --rate 5 --duration 120 --env PARSE_WORKERS=4 --out r5_pw4.json
+    python loadtest.py --mix generate=1 --uploads zip=1 --zip-pdfs 20 --pages 10
+"""
+import argparse, asyncio, io, json, math, os, random, signal, subprocess, sys, time, zipfile
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    sys.exit("loadtest.py requiere httpx: pip install httpx")
+
+# -----------------------
+# PDFs sintéticos
+# -----------------------
+_PARAMS = [
+    ("HEMATOCRITO", 30, 50), ("HEMOGLOBINA", 9, 17), ("LEUCOCITOS", 3, 15),
+    ("NEUTRÓFILOS", 40, 80), ("LINFOCITOS", 10, 45), ("PLAQUETAS", 120, 450),
+    ("GLUCOSA", 70, 180), ("CREATININA", 0.5, 2.5), ("BUN", 8, 40),
+    ("SODIO", 130, 148), ("POTASIO", 3.2, 5.5), ("CLORO", 95, 110),
+    ("PROTEÍNA C REACTIVA", 0.1, 30), ("INR", 0.9, 3.0),
+]
+
+def make_pdf(pages: list[list[str]]) -> bytes:
+    """PDF mínimo (Helvetica, WinAnsi) con una línea de texto por renglón."""
+    objs = []
+
+    def add(body: bytes) -> int:
+        objs.append(body)
+        return len(objs)
+
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+    pages_id = len(objs) + 1 + 2 * len(pages)
+    kids = []
+    for lines in pages:
+        ops = [b"BT /F1 10 Tf 14 TL 40 800 Td"]
+        for ln in lines:
+            s = ln.encode("cp1252").replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+            ops.append(b"(" + s + b") Tj T*")
+        ops.append(b"ET")
+        stream = b"\n".join(ops)
+        content = add(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        kids.append(add(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 595 842] /Contents %d 0 R "
+            b"/Resources << /Font << /F1 %d 0 R >> >> >>" % (pages_id, content, font)
+        ))
+    add(b"<< /Type /Pages /Kids [" + b" ".join(b"%d 0 R" % k for k in kids) + b"] /Count %d >>" % len(kids))
+    catalog = add(b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id)
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objs, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % i + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objs) + 1)
+    for off in offsets:
+        out += b"%010d 00000 n \n" % off
+    out += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objs) + 1, catalog, xref)
+    return bytes(out)
+
+def synthetic_report(rng: random.Random, pages: int) -> bytes:
+    """Informe de laboratorio con una Recepción distinta por página y valores al azar."""
+    page_lines = []
+    for _ in range(pages):
+        day, hour, minute = rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59)
+        lines = ["LABORATORIO CLINICO", f"Recepción: {day:02d}/03/2025 {hour:02d}:{minute:02d}"]
+        for name, lo, hi in _PARAMS:
+            lines.append(f"{name}: {rng.uniform(lo, hi):.1f}")
+        page_lines.append(lines)
+    return make_pdf(page_lines)
+
+def build_upload(kind: str, rng: random.Random, args) -> list[tuple]:
+    """Lista de campos 'files' para httpx según el tipo de upload."""
+    if kind == "single":
+        return [("files", ("informe.pdf", synthetic_report(rng, args.pages), "application/pdf"))]
+    if kind == "multi":
+        return [
+            ("files", (f"informe_{i}.pdf", synthetic_report(rng, args.pages), "application/pdf"))
+            for i in range(args.multi_pdfs)
+        ]
+    if kind == "zip":
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+            for i in range(args.zip_pdfs):
+                zf.writestr(f"informe_{i}.pdf", synthetic_report(rng, args.pages))
+        return [("files", ("informes.zip", buf.getvalue(), "application/zip"))]
+    raise ValueError(f"tipo de upload desconocido: {kind}")
+
+# -----------------------
+# RSS del servidor (Linux /proc)
+# -----------------------
+def _children(pid: int) -> list[int]:
+    kids = []
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                kids += [int(c) for c in f.read().split()]
+    except OSError:
+        pass
+    return kids
+
+def tree_rss(pid: int) -> int:
+    """RSS en bytes del proceso y todos sus descendientes (workers de uvicorn y de parseo)."""
+    total, stack = 0, [pid]
+    while stack:
+        p = stack.pop()
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+        stack += _children(p)
+    return total
+
+async def sample_rss(pid: int, t0: float, interval: float, timeline: list, stop: asyncio.Event):
+    while not stop.is_set():
+        timeline.append({"t": round(time.monotonic() - t0, 3), "rss": tree_rss(pid)})
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+# -----------------------
+# Servidor
+# -----------------------
+def start_server(args) -> subprocess.Popen:
+    env = dict(os.environ)
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    cmd = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+           "--port", str(args.port), "--workers", str(args.workers), "--log-level", "warning"]
+    here = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.Popen(cmd, cwd=here, env=env, start_new_session=True)
+
+async def wait_ready(client: httpx.AsyncClient, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/health")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.25)
+    raise RuntimeError("el servidor no respondió /health a tiempo")
+
+def stop_server(proc: subprocess.Popen):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=15)
+    except ProcessLookupError:
+        pass
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+
+# -----------------------
+# Carga
+# -----------------------
+def parse_weights(spec: str) -> dict[str, float]:
+    weights = {}
+    for item in spec.split(","):
+        key, _, value = item.partition("=")
+        weights[key.strip()] = float(value or 1)
+    return weights
+
+def pick(rng: random.Random, weights: dict[str, float]) -> str:
+    return rng.choices(list(weights), weights=list(weights.values()))[0]
+
+async def one_request(client: httpx.AsyncClient, rng: random.Random, args, results: list, t0: float):
+    endpoint = pick(rng, args.mix_weights)
+    kind = None
+    start = time.monotonic()
+    try:
+        if endpoint == "health":
+            resp = await client.get("/health")
+        else:
+            kind = pick(rng, args.upload_weights)
+            # sin --repeat-uploads cada request lleva valores distintos y no pega en la cache
+            upload_rng = random.Random(0) if args.repeat_uploads else rng
+            files = build_upload(kind, upload_rng, args)
+            start = time.monotonic()
+            resp = await client.post(f"/{endpoint}", files=files)
+        status, error = resp.status_code, None
+    except httpx.HTTPError as exc:
+        status, error = None, type(exc).__name__
+    end = time.monotonic()
+    results.append({
+        "endpoint": endpoint, "upload": kind, "status": status, "error": error,
+        "start": round(start - t0, 4), "latency": end - start,
+    })
+
+async def closed_loop(client, args, results, t0, stop_at):
+    """--concurrency: N clientes que envían el siguiente request apenas vuelve el anterior."""
+    async def worker(i: int):
+        rng = random.Random(args.seed + i)
+        while time.monotonic() < stop_at:
+            await one_request(client, rng, args, results, t0)
+    await asyncio.gather(*[worker(i) for i in range(args.concurrency)])
+
+async def open_loop(client, args, results, t0, stop_at):
+    """--rate: llegadas Poisson a la tasa pedida, sin esperar respuestas (como usuarios reales)."""
+    rng = random.Random(args.seed)
+    tasks = []
+    while time.monotonic() < stop_at:
+        tasks.append(asyncio.create_task(
+            one_request(client, random.Random(rng.random()), args, results, t0)
+        ))
+        await asyncio.sleep(rng.expovariate(args.rate))
+    await asyncio.gather(*tasks)
+
+def percentile(sorted_values: list[float], q: float) -> float | None:
+    if not sorted_values:
+        return None
+    # nearest-rank
+    rank = math.ceil(q / 100 * len(sorted_values))
+    return sorted_values[max(0, min(len(sorted_values), rank) - 1)]
+
+def summarize(results: list[dict], elapsed: float) -> dict:
+    ok = [r for r in results if r["status"] is not None and r["status"] < 400]
+    lat = sorted(r["latency"] for r in ok)
+    statuses: dict[str, int] = {}
+    for r in results:
+        key = str(r["status"]) if r["status"] is not None else r["error"]
+        statuses[key] = statuses.get(key, 0) + 1
+    return {
+        "requests": len(results),
+        "ok": len(ok),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else None,
+        "throughput_rps": round(len(ok) / elapsed, 3) if elapsed else None,
+        "latency_s": {
+            "p50": percentile(lat, 50), "p95": percentile(lat, 95), "p99": percentile(lat, 99),
+            "max": lat[-1] if lat else None,
+        },
+        "statuses": statuses,
+    }
+
+async def run(args) -> dict:
+    proc = None if args.url else start_server(args)
+    base_url = args.url or f"http://127.0.0.1:{args.port}"
+    headers = {"x-api-key": args.api_key} if args.api_key else {}
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, headers=headers, limits=limits,
+                                     timeout=args.timeout) as client:
+            await wait_ready(client)
+            server_pid = proc.pid if proc else args.server_pid
+
+            if args.warmup > 0:
+                warm_stop = time.monotonic() + args.warmup
+                await closed_loop(client, args, [], time.monotonic(), warm_stop)
+
+            results, timeline = [], []
+            stop = asyncio.Event()
+            t0 = time.monotonic()
+            sampler = (
+                asyncio.create_task(sample_rss(server_pid, t0, args.rss_interval, timeline, stop))
+                if server_pid else None
+            )
+            stop_at = t0 + args.duration
+            if args.rate:
+                await open_loop(client, args, results, t0, stop_at)
+            else:
+                await closed_loop(client, args, results, t0, stop_at)
+            elapsed = time.monotonic() - t0
+            stop.set()
+            if sampler:
+                await sampler
+    finally:
+        if proc:
+            stop_server(proc)
+
+    by_endpoint = {
+        ep: summarize([r for r in results if r["endpoint"] == ep], elapsed)
+        for ep in sorted({r["endpoint"] for r in results})
+    }
+    rss_values = [s["rss"] for s in timeline]
+    return {
+        "config": {
+            k: v for k, v in vars(args).items() if k not in ("mix_weights", "upload_weights", "out")
+        },
+        "elapsed_s": round(elapsed, 3),
+        "summary": summarize(results, elapsed),
+        "by_endpoint": by_endpoint,
+        "rss": {
+            "peak": max(rss_values) if rss_values else None,
+            "start": rss_values[0] if rss_values else None,
+            "end": rss_values[-1] if rss_values else None,
+            "timeline": timeline,
+        },
+        "requests": results if args.keep_requests else None,
+    }
+
+def print_report(report: dict):
+    def fmt(v):
+        return "-" if v is None else f"{v * 1000:.0f}ms"
+    mb = 1024 * 1024
+    rows = [("TOTAL", report["summary"])] + list(report["by_endpoint"].items())
+    print(f"{'endpoint':<15}{'reqs':>7}{'err%':>7}{'rps':>8}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, s in rows:
+        lat = s["latency_s"]
+        err = "-" if s["error_rate"] is None else f"{s['error_rate'] * 100:.1f}"
+        print(f"{name:<15}{s['requests']:>7}{err:>7}{s['throughput_rps'] or 0:>8.2f}"
+              f"{fmt(lat['p50']):>9}{fmt(lat['p95']):>9}{fmt(lat['p99']):>9}")
+    print("statuses:", report["summary"]["statuses"])
+    rss = report["rss"]
+    if rss["peak"]:
+        print(f"server RSS: start {rss['start'] / mb:.0f}MB  peak {rss['peak'] / mb:.0f}MB  "
+              f"end {rss['end'] / mb:.0f}MB")
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--url", help="servidor ya levantado (no se inicia uvicorn)")
+    ap.add_argument("--server-pid", type=int, help="PID del servidor para medir RSS con --url")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--workers", type=int, default=1, help="workers de uvicorn")
+    ap.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                    help="variable de entorno para el servidor (repetible)")
+    ap.add_argument("--api-key", default=os.getenv("API_KEY", ""))
+    load = ap.add_mutually_exclusive_group()
+    load.add_argument("--concurrency", type=int, default=4, help="clientes concurrentes (lazo cerrado)")
+    load.add_argument("--rate", type=float, help="requests/s con llegadas Poisson (lazo abierto)")
+    ap.add_argument("--duration", type=float, default=30.0, help="segundos de medición")
+    ap.add_argument("--warmup", type=float, default=3.0, help="segundos de calentamiento sin medir")
+    ap.add_argument("--mix", default="generate=0.45,generate_json=0.45,health=0.1",
+                    help="peso por endpoint: generate, generate_json, health")
+    ap.add_argument("--uploads", default="single=0.6,multi=0.3,zip=0.1",
+                    help="peso por tipo de upload: single, multi, zip")
+    ap.add_argument("--pages", type=int, default=3, help="páginas por PDF sintético")
+    ap.add_argument("--multi-pdfs", type=int, default=3, help="PDFs por upload 'multi'")
+    ap.add_argument("--zip-pdfs", type=int, default=12, help="PDFs dentro del upload 'zip'")
+    ap.add_argument("--repeat-uploads", action="store_true",
+                    help="repetir siempre los mismos archivos (mide la cache de resultados)")
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--rss-interval", type=float, default=0.5)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--keep-requests", action="store_true", help="incluir cada request en el JSON")
+    ap.add_argument("--out", help="archivo JSON de resultados")
+    args = ap.parse_args()
+    args.mix_weights = parse_weights(args.mix)
+    args.upload_weights = parse_weights(args.uploads)
+    if args.rate:
+        args.concurrency = 1  # solo para el warmup
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"resultados en {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,51 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request
-from fastapi.responses import StreamingResponse, PlainTextResponse, HTMLResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse, HTMLResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-import pdfplumber, io, re, datetime, tempfile, os, traceback
+from starlette.datastructures import Headers
+import pdfplumber, io, re, datetime, tempfile, os, traceback, mmap, asyncio, time, threading, logging, contextlib, hashlib, signal, shutil, errno
+from collections import OrderedDict
+from xml.etree import ElementTree
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from docxtpl import DocxTemplate
-import base64
+import base64, zipfile, json
 
 API_KEY = os.getenv("API_KEY", "")
 
-app = FastAPI(title="LabFluxHPH Backend")
+# Spool de uploads: tmpfs si existe, para que los workers reciban rutas y no bytes.
+# Si el tmpfs se llena (ENOSPC), el resto del request sigue en disco (RequestSpool).
+SPOOL_DIR = os.getenv("SPOOL_DIR") or ("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+SPOOL_CHUNK = 1024 * 1024
+# 0 -> parseo en el threadpool del proceso; N > 0 -> pool de N procesos
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", "0"))
+# Plazo por request en segundos (0 = sin plazo) y cada cuánto se revisa si el cliente se fue
+REQUEST_DEADLINE_S = float(os.getenv("REQUEST_DEADLINE_S", "90"))
+DISCONNECT_POLL_S = 0.5
+# Tope de páginas por PDF (0 = sin tope) y período de muestreo de RSS
+MAX_PDF_PAGES = int(os.getenv("MAX_PDF_PAGES", "500"))
+RSS_SAMPLE_S = 0.05
+# Cache de DOCX generados (0 = desactivado)
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_TTL_S = float(os.getenv("RESULT_CACHE_TTL_S", "600"))
+# Subir cuando cambien las reglas de parseo/contexto: invalida la cache de resultados
+PARSER_VERSION = "3"
+# "fast" = plantilla precompilada (cae a docxtpl si no aplica); "docxtpl" = siempre Jinja
+RENDER_ENGINE = os.getenv("RENDER_ENGINE", "fast")
+
+# Se loguea por el logger de uvicorn para salir en los logs del servicio sin configurar nada
+logger = logging.getLogger("uvicorn.error")
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Precompila la plantilla antes de recibir tráfico (unos segundos con docxtpl)
+    if RENDER_ENGINE == "fast":
+        await asyncio.to_thread(get_compiled_template)
+    yield
+    for executor in (_parse_pool, _parse_threads):
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+app = FastAPI(title="LabFluxHPH Backend", lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 app.add_middleware(
@@ -19,12 +56,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.middleware("http")
-async def auth_middleware(request: Request, call_next):
-    if API_KEY:
-        if request.headers.get("x-api-key") != API_KEY:
-            return PlainTextResponse("Unauthorized", status_code=401)
-    return await call_next(request)
+class APIKeyMiddleware:
+    """
+    Middleware ASGI puro: a diferencia de @app.middleware("http") no envuelve 'receive',
+    así los endpoints pueden detectar cuando el cliente se desconecta.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if API_KEY and scope["type"] == "http":
+            if Headers(scope=scope).get("x-api-key") != API_KEY:
+                response = PlainTextResponse("Unauthorized", status_code=401)
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+app.add_middleware(APIKeyMiddleware)
 
 @app.exception_handler(Exception)
 async def all_exception_handler(request, exc):
@@ -158,69 +206,23 @@ ALIAS_BY_PANEL = {
     }
 }
 
-# -----------------------
-# Utilidades
-# -----------------------
-def detect_panel_page(text: str) -> str:
-    """Detecta el panel de una página por marcadores y, si no, por heurísticas."""
-    for panel, pats in SECTION_MARKERS.items():
-        for pat in pats:
-            if re.search(pat, text, flags=re.I):
-                return panel
-    # Heurística secundaria
-    text_low = text.lower()
-    oc_hits = any(k in text_low for k in [
-        "orina completa", "sed.u", "sed u", "uroan", "urobil", "cilindros", "bacterias", "leucocitos en orina"
-    ])
-    cultivo_hits = any(k in text_low for k in [
-        "urocultivo", "hemocultivo", "antibiograma", "gram", "tinción de gram", "cultivo"
-    ])
-    if oc_hits and not cultivo_hits:
-        return "oc"
-    if cultivo_hits:
-        return "cultivo"
-    return "resto"
-
-def match_alias_in_panel(name: str, panel: str) -> str | None:
-    """Primero intenta alias del panel; si no, cae a 'resto' para términos globales."""
-    for pat, std in ALIAS_BY_PANEL.get(panel, {}).items():
-        if re.search(pat, name, flags=re.I):
-            return std
-    if panel != "resto":
-        for pat, std in ALIAS_BY_PANEL["resto"].items():
-            if re.search(pat, name, flags=re.I):
-                return std
-    return None
-
-def heuristic_alias(name: str, panel: str) -> str | None:
-    """Heurísticas por 'contains' cuando no hay match exacto."""
-    n = name.lower().strip()
-    if panel == "oc":
-        tests = [
-            ("color", "coloroc"), ("aspect", "aspectooc"), ("densid", "densoc"),
-            (" ph", "phoc"), ("ph ", "phoc"), ("nitrit", "nitritosoc"),
-            ("prote", "protoc"), ("ceton", "cetonasoc"), ("gluco", "glucosaoc"),
-            ("urobil", "urobiloc"), ("bilir", "bilioc"), ("muc", "mucusoc"),
-            ("leuco", "leucosoc"), ("eritro", "groc"), ("globulos rojos", "groc"),
-            ("bacter", "bactoc"), ("hial", "hialoc"), ("granul", "granuloc"),
-            ("epitel", "epiteloc"), ("cristal", "cristaloc"), ("levad", "levadoc")
-        ]
-        for sub, std in tests:
-            if sub in n:
-                return std
-        return None
-    if panel == "cultivo":
-        tests = [
-            ("gram", "gram"), ("antibio", "ATB"),
-            ("microorgan", "agente"), ("agente", "agente"),
-            ("muestra", "muestra")
-        ]
-        for sub, std in tests:
-            if sub in n:
-                return std
-        return None
-    # resto
-    tests = [
+# Heurísticas por 'contains' cuando no hay match exacto (paneles sin lista usan 'resto')
+HEURISTICS_BY_PANEL = {
+    "oc": [
+        ("color", "coloroc"), ("aspect", "aspectooc"), ("densid", "densoc"),
+        (" ph", "phoc"), ("ph ", "phoc"), ("nitrit", "nitritosoc"),
+        ("prote", "protoc"), ("ceton", "cetonasoc"), ("gluco", "glucosaoc"),
+        ("urobil", "urobiloc"), ("bilir", "bilioc"), ("muc", "mucusoc"),
+        ("leuco", "leucosoc"), ("eritro", "groc"), ("globulos rojos", "groc"),
+        ("bacter", "bactoc"), ("hial", "hialoc"), ("granul", "granuloc"),
+        ("epitel", "epiteloc"), ("cristal", "cristaloc"), ("levad", "levadoc")
+    ],
+    "cultivo": [
+        ("gram", "gram"), ("antibio", "ATB"),
+        ("microorgan", "agente"), ("agente", "agente"),
+        ("muestra", "muestra")
+    ],
+    "resto": [
         ("hematoc", "hto"), ("hemogl", "hb"), ("vcm", "vcm"), ("hcm", "hcm"),
         ("leuco", "leuco"), ("neutro", "neu"), ("linfo", "linfocitos"),
         ("monoc", "mono"), ("eosin", "eosin"), ("baso", "basofilos"),
@@ -241,17 +243,324 @@ def heuristic_alias(name: str, panel: str) -> str | None:
         ("exceso de base", "base"), ("ebvt", "base"),
         ("porcentaje", "tp"), ("inr", "inr"), ("ttpa", "ttpk"),
         (" ph", "ph"), ("ph ", "ph")
-    ]
+    ],
+}
+
+# Heurística secundaria de panel cuando no hay marcadores (texto en minúsculas)
+PANEL_KEYWORDS = {
+    "oc": ["orina completa", "sed.u", "sed u", "uroan", "urobil", "cilindros", "bacterias", "leucocitos en orina"],
+    "cultivo": ["urocultivo", "hemocultivo", "antibiograma", "gram", "tinción de gram", "cultivo"],
+}
+
+# -----------------------
+# Perfiles de alias por laboratorio
+# -----------------------
+ALIAS_PROFILES_PATH = os.getenv(
+    "ALIAS_PROFILES_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "alias_profiles.json"),
+)
+PROFILE_RELOAD_S = 2.0
+# La huella del laboratorio se busca solo en el encabezado de la página
+PROFILE_HEADER_CHARS = 800
+# Los marcadores de panel se buscan primero en estas primeras líneas
+PANEL_HEADER_LINES = 8
+
+def _lower_pattern(pattern: str) -> str:
+    """
+    Pasa a minúsculas los literales de un regex, sin tocar los escapes (\\S, \\W, \\B...)
+    ni los grupos con nombre ((?P<nombre>...) y (?P=nombre)).
+    """
+    out, i = [], 0
+    while i < len(pattern):
+        if pattern.startswith(("(?P<", "(?P="), i):
+            end = pattern.find(">" if pattern[i + 3] == "<" else ")", i)
+            end = len(pattern) if end < 0 else end + 1
+            out.append(pattern[i:end])
+            i = end
+        elif pattern[i] == "\\":
+            out.append(pattern[i:i + 2])
+            i += 2
+        else:
+            out.append(pattern[i].lower())
+            i += 1
+    return "".join(out)
+
+_LEADING_BOUNDARY_RE = re.compile(r"^(?:\\b|\^)*")
+_FIRST_CLASS_RE = re.compile(r"^\[([^\]\\^-]+)\]")
+
+def _first_chars(pattern: str) -> str | None:
+    """
+    Caracteres con que puede empezar un match de un marcador simple ('ORINA\\s+COMPLETA',
+    '\\bUROAN[ÁA]LISIS\\b'); None si no se puede asegurar (alternancias, escapes, opcionales).
+    """
+    if "|" in pattern:
+        return None
+    p = _LEADING_BOUNDARY_RE.sub("", pattern)
+    m = _FIRST_CLASS_RE.match(p)
+    if m:
+        chars, rest = m.group(1), p[m.end():]
+    elif p and (p[0].isalnum() or p[0] == " "):
+        chars, rest = p[0], p[1:]
+    else:
+        return None
+    if rest[:1] in ("?", "*", "{"):
+        return None
+    return chars
+
+class AliasProfile:
+    """
+    Tablas de un laboratorio compiladas una sola vez. Las que el perfil no define se
+    heredan de las tablas base (SECTION_MARKERS, ALIAS_BY_PANEL, ...); las que define
+    las reemplazan, así solo se busca en el set de alias de ese laboratorio.
+    """
+    def __init__(self, name: str, fingerprint: list[str] | None = None,
+                 section_markers: dict | None = None, alias_by_panel: dict | None = None,
+                 heuristics: dict | None = None, panel_keywords: dict | None = None):
+        self.name = name
+        self.fingerprint = (
+            re.compile("|".join(f"(?:{p})" for p in fingerprint), re.I) if fingerprint else None
+        )
+        self.section_markers = section_markers or SECTION_MARKERS
+        self.marker_re, self.marker_groups = self._compile_markers(self.section_markers)
+        self.alias_by_panel = {
+            panel: [(re.compile(p, re.I), std) for p, std in aliases.items()]
+            for panel, aliases in (alias_by_panel or ALIAS_BY_PANEL).items()
+        }
+        self.heuristics = {
+            panel: [(sub.lower(), std) for sub, std in tests]
+            for panel, tests in (heuristics or HEURISTICS_BY_PANEL).items()
+        }
+        self.panel_keywords = {
+            panel: [k.lower() for k in keywords]
+            for panel, keywords in (panel_keywords or PANEL_KEYWORDS).items()
+        }
+
+    @staticmethod
+    def _compile_markers(section_markers: dict) -> tuple[re.Pattern | None, dict[str, str]]:
+        """
+        Todos los marcadores en un único patrón sobre texto en minúsculas, con un grupo con
+        nombre por panel. Si se conoce con qué letras puede empezar cada marcador, un
+        lookahead con esas letras evita probar todas las alternativas en cada posición.
+        """
+        groups, alternatives, first = {}, [], set()
+        for i, (panel, pats) in enumerate(section_markers.items()):
+            if not pats:
+                continue
+            groups[f"p{i}"] = panel
+            lowered = [_lower_pattern(p) for p in pats]
+            alternatives.append(f"(?P<p{i}>" + "|".join(lowered) + ")")
+            for p in lowered:
+                chars = _first_chars(p)
+                if chars is None:
+                    first = None
+                elif first is not None:
+                    first.update(chars)
+        if not alternatives:
+            return None, groups
+        combined = "|".join(alternatives)
+        if first:
+            combined = "(?=[" + "".join(re.escape(c) for c in sorted(first)) + "])(?:" + combined + ")"
+        return re.compile(combined), groups
+
+    def matches(self, header: str) -> bool:
+        return self.fingerprint is not None and self.fingerprint.search(header) is not None
+
+DEFAULT_PROFILE = AliasProfile("default")
+
+class ProfileSet:
+    """Perfiles vigentes (inmutable: una recarga crea otro y se reemplaza la referencia)."""
+    def __init__(self, version: str, profiles: list[AliasProfile], default: AliasProfile):
+        self.version = version
+        self.profiles = profiles
+        self.default = default
+
+    def select(self, text: str) -> AliasProfile:
+        header = text[:PROFILE_HEADER_CHARS]
+        for profile in self.profiles:
+            if profile.matches(header):
+                return profile
+        return self.default
+
+BUILTIN_PROFILES = ProfileSet("builtin", [], DEFAULT_PROFILE)
+
+def load_alias_profiles(path: str) -> ProfileSet:
+    """
+    Lee perfiles desde JSON:
+      {"profiles": [{"name": "labx", "fingerprint": ["LABORATORIO X"],
+                     "alias_by_panel": {...}, "section_markers": {...},
+                     "heuristics": {...}, "panel_keywords": {...}}]}
+    Se usa el primer perfil cuya huella aparece en el encabezado de la página. Un perfil
+    "default" sin huella reemplaza al perfil base. La versión es el hash del archivo.
+    """
+    with open(path, "rb") as f:
+        raw = f.read()
+    data = json.loads(raw)
+    default = DEFAULT_PROFILE
+    profiles = []
+    for spec in data.get("profiles", []):
+        fingerprint = spec.get("fingerprint")
+        if fingerprint is not None and not (
+                isinstance(fingerprint, list) and all(isinstance(p, str) and p.strip() for p in fingerprint)):
+            # un patrón vacío (o un string partido en letras) coincidiría con todas las páginas
+            raise ValueError(f"perfil {spec.get('name')!r}: 'fingerprint' debe ser una lista de textos no vacíos")
+        profile = AliasProfile(**spec)
+        if profile.name == "default" and profile.fingerprint is None:
+            default = profile
+        else:
+            profiles.append(profile)
+    return ProfileSet(hashlib.sha256(raw).hexdigest()[:16], profiles, default)
+
+_alias_profiles = BUILTIN_PROFILES
+_alias_profiles_mtime: int | None = None
+_alias_profiles_checked = float("-inf")
+_alias_profiles_lock = threading.Lock()
+
+def get_alias_profiles(expected_version: str | None = None) -> ProfileSet:
+    """
+    Perfiles vigentes. Como mucho cada PROFILE_RELOAD_S revisa el mtime del archivo y, si
+    cambió, lo recompila y reemplaza la referencia; si el archivo es inválido se mantiene
+    la versión anterior. Cada proceso (también los workers de parseo) recarga por su cuenta;
+    con expected_version (la que vio el proceso padre) y una versión distinta en memoria,
+    revisa el archivo sin esperar el intervalo.
+    """
+    global _alias_profiles, _alias_profiles_mtime, _alias_profiles_checked
+    stale = expected_version is not None and expected_version != _alias_profiles.version
+    if not stale and time.monotonic() - _alias_profiles_checked < PROFILE_RELOAD_S:
+        return _alias_profiles
+    with _alias_profiles_lock:
+        now = time.monotonic()
+        stale = expected_version is not None and expected_version != _alias_profiles.version
+        if not stale and now - _alias_profiles_checked < PROFILE_RELOAD_S:
+            return _alias_profiles
+        _alias_profiles_checked = now
+        try:
+            mtime = os.stat(ALIAS_PROFILES_PATH).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != _alias_profiles_mtime:
+            _alias_profiles_mtime = mtime
+            if mtime is None:
+                _alias_profiles = BUILTIN_PROFILES
+            else:
+                try:
+                    _alias_profiles = load_alias_profiles(ALIAS_PROFILES_PATH)
+                    logger.info("Perfiles de alias cargados: versión %s", _alias_profiles.version)
+                except (OSError, ValueError, TypeError, AttributeError, re.error) as exc:
+                    logger.warning("Perfiles de alias inválidos en %s, se mantiene la versión %s: %s",
+                                   ALIAS_PROFILES_PATH, _alias_profiles.version, exc)
+    return _alias_profiles
+
+# -----------------------
+# Utilidades
+# -----------------------
+def detect_panel_regions(text: str, profile: AliasProfile = DEFAULT_PROFILE) -> list[tuple[int, str]]:
+    """
+    Panel(es) de una página como [(línea de inicio, panel)]:
+    - Marcadores de un solo panel en el encabezado (PANEL_HEADER_LINES) y ningún marcador
+      de otro panel en el resto de la página -> ese panel.
+    - Si no (encabezado sin marcadores o con varios paneles, u otro panel más abajo, como
+      "Solicitud: UROCULTIVO" sobre una sección ORINA COMPLETA), se escanea la página
+      completa. Solo un título (línea que es únicamente un marcador) abre una región: un
+      marcador dentro de una fila o comentario ("Observación: se sugiere urocultivo") no.
+      Títulos seguidos sin contenido entre ellos (paneles listados en el encabezado) son un
+      solo bloque con el panel de mayor prioridad.
+    - Si no quedan al menos dos regiones, toda la página toma el primer panel, en el orden
+      de SECTION_MARKERS, con algún marcador (como la detección anterior).
+    - Sin marcadores, heurística secundaria por palabras clave.
+    """
+    text_low = text.lower()
+    marker_re = profile.marker_re
+    if marker_re is None:
+        return [(0, detect_panel_by_keywords(text_low, profile))]
+
+    header_end = -1
+    for _ in range(PANEL_HEADER_LINES):
+        header_end = text_low.find("\n", header_end + 1)
+        if header_end < 0:
+            header_end = len(text_low)
+            break
+    header_panels = {profile.marker_groups[m.lastgroup] for m in marker_re.finditer(text_low, 0, header_end)}
+    if len(header_panels) == 1:
+        panel = header_panels.pop()
+        if all(profile.marker_groups[m.lastgroup] == panel for m in marker_re.finditer(text_low, header_end)):
+            return [(0, panel)]
+
+    found, titles = set(), []
+    line_no = line_pos = 0
+    for m in marker_re.finditer(text_low):
+        panel = profile.marker_groups[m.lastgroup]
+        found.add(panel)
+        line_no += text_low.count("\n", line_pos, m.start())
+        line_pos = m.start()
+        start = text_low.rfind("\n", 0, m.start()) + 1
+        end = text_low.find("\n", m.end())
+        if marker_re.fullmatch(text_low[start:end if end >= 0 else len(text_low)].strip()):
+            titles.append((line_no, panel))
+    if not found:
+        return [(0, detect_panel_by_keywords(text_low, profile))]
+
+    priority = list(profile.section_markers)
+    page_panel = min(found, key=priority.index)
+    if len({panel for _, panel in titles}) < 2:
+        return [(0, page_panel)]
+
+    lines = text_low.split("\n")
+    blocks, prev_line = [], None
+    for line_no, panel in titles:
+        if blocks and not any(line.strip() for line in lines[prev_line + 1:line_no]):
+            if priority.index(panel) < priority.index(blocks[-1][1]):
+                blocks[-1][1] = panel
+        else:
+            blocks.append([line_no, panel])
+        prev_line = line_no
+
+    regions = []
+    for line_no, panel in blocks:
+        if not regions:
+            regions.append((0, panel))
+        elif panel != regions[-1][1]:
+            regions.append((line_no, panel))
+    if len(regions) < 2:
+        return [(0, page_panel)]
+    return regions
+
+def detect_panel_by_keywords(text_low: str, profile: AliasProfile = DEFAULT_PROFILE) -> str:
+    """Heurística secundaria cuando la página no tiene marcadores."""
+    oc_hits = any(k in text_low for k in profile.panel_keywords.get("oc", []))
+    cultivo_hits = any(k in text_low for k in profile.panel_keywords.get("cultivo", []))
+    if oc_hits and not cultivo_hits:
+        return "oc"
+    if cultivo_hits:
+        return "cultivo"
+    return "resto"
+
+def match_alias_in_panel(name: str, panel: str, profile: AliasProfile = DEFAULT_PROFILE) -> str | None:
+    """Primero intenta alias del panel; si no, cae a 'resto' para términos globales."""
+    for pat, std in profile.alias_by_panel.get(panel, []):
+        if pat.search(name):
+            return std
+    if panel != "resto":
+        for pat, std in profile.alias_by_panel.get("resto", []):
+            if pat.search(name):
+                return std
+    return None
+
+def heuristic_alias(name: str, panel: str, profile: AliasProfile = DEFAULT_PROFILE) -> str | None:
+    """Heurísticas por 'contains' cuando no hay match exacto."""
+    n = name.lower().strip()
+    tests = profile.heuristics.get(panel)
+    if tests is None:
+        tests = profile.heuristics.get("resto", [])
     for sub, std in tests:
         if sub in n:
             return std
     return None
 
-def coalesce_alias(name: str, panel: str) -> str | None:
-    std = match_alias_in_panel(name, panel)
+def coalesce_alias(name: str, panel: str, profile: AliasProfile = DEFAULT_PROFILE) -> str | None:
+    std = match_alias_in_panel(name, panel, profile)
     if std:
         return std
-    return heuristic_alias(name, panel)
+    return heuristic_alias(name, panel, profile)
 
 def extract_numeric_head(s: str) -> str:
     """Obtiene el primer número (con coma o punto) de una cadena, o retorna s si no hay número."""
@@ -359,26 +668,130 @@ def parse_recepcion_datetime(text: str):
 
     return None
 
+# -----------------------
+# Memoria y métricas
+# -----------------------
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def current_rss() -> int:
+    """RSS actual del proceso en bytes (/proc en Linux; si no, el máximo de getrusage)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class RssSampler:
+    """Muestrea el RSS del proceso en un hilo mientras dura el bloque y guarda el pico."""
+    def __init__(self, interval: float = RSS_SAMPLE_S):
+        self.interval = interval
+        self.start = self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self.start = self.peak = current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+# Métricas del proceso (cada worker de uvicorn lleva las suyas), expuestas en /metrics
+METRICS = {
+    "requests": 0,
+    "pdfs": 0,
+    "pages": 0,
+    "peak_rss_last": 0,
+    "peak_rss_max": 0,
+    "worker_peak_rss_max": 0,
+}
+_metrics_lock = threading.Lock()
+
+@contextlib.contextmanager
+def track_request(endpoint: str):
+    """Mide pico de RSS y duración del request; parse_pdfs completa pdfs/pages/worker_peak_rss."""
+    stats = {"pdfs": 0, "pages": 0, "worker_peak_rss": 0}
+    t0 = time.monotonic()
+    rss = RssSampler()
+    try:
+        with rss:
+            yield stats
+    finally:
+        with _metrics_lock:
+            METRICS["requests"] += 1
+            METRICS["pdfs"] += stats["pdfs"]
+            METRICS["pages"] += stats["pages"]
+            METRICS["peak_rss_last"] = rss.peak
+            METRICS["peak_rss_max"] = max(METRICS["peak_rss_max"], rss.peak)
+            METRICS["worker_peak_rss_max"] = max(METRICS["worker_peak_rss_max"], stats["worker_peak_rss"])
+        mb = 1024 * 1024
+        logger.info(
+            "%s pdfs=%d pages=%d peak_rss=%.1fMB (+%.1fMB) worker_peak_rss=%.1fMB t=%.2fs",
+            endpoint, stats["pdfs"], stats["pages"], rss.peak / mb, (rss.peak - rss.start) / mb,
+            stats["worker_peak_rss"] / mb, time.monotonic() - t0,
+        )
+
 # -----------------------
 # Parser por página
 # -----------------------
-def parse_pdf(file_bytes: bytes):
+def _should_stop(deadline: float | None, cancel_path: str | None) -> bool:
+    """Venció el plazo (reloj monotónico, común a todos los procesos) o el request fue cancelado."""
+    if deadline is not None and time.monotonic() >= deadline:
+        return True
+    return bool(cancel_path) and os.path.exists(cancel_path)
+
+class PageLimitExceeded(Exception):
+    """El PDF supera MAX_PDF_PAGES."""
+
+def parse_pdf(pdf_path: str, deadline: float | None = None, cancel_path: str | None = None,
+              profiles_version: str | None = None):
     """
     Paso 2: parseo por página con panel/contexto independiente, alias por panel + heurísticas,
     y Fecha/Hora de Recepción por página (cultivo -> genera fechacul/horacul).
+    Recibe la ruta del PDF en el spool y lo abre memory-mapped (sin copiarlo a un BytesIO).
+    Entre páginas revisa el plazo y el archivo de cancelación; si corta, informa las páginas
+    que quedaron sin procesar en 'skipped_pages'.
+    Cada página se cierra apenas se extrae su texto, para que pdfplumber suelte su layout
+    y la memoria no crezca con el largo del documento.
+    El perfil de alias se elige por página según la huella del encabezado; profiles_version
+    es la versión de perfiles que vio el request y 'profiles_version' en el resultado, la
+    que realmente se usó.
+    Una página puede traer más de un panel (p. ej. orina completa y urocultivo): cada línea
+    toma el panel de la región en que cae.
     """
     rows = []
-    with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
-        for page_index, page in enumerate(pdf.pages):
+    skipped_pages = []
+    profiles = get_alias_profiles(profiles_version)
+    with open(pdf_path, "rb") as fh, \
+            mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            pdfplumber.open(mm) as pdf:
+        pages = pdf.pages
+        if MAX_PDF_PAGES and len(pages) > MAX_PDF_PAGES:
+            raise PageLimitExceeded(len(pages))
+        for page_index, page in enumerate(pages):
+            if _should_stop(deadline, cancel_path):
+                skipped_pages = list(range(page_index, len(pages)))
+                break
             text = page.extract_text() or ""
+            page.close()
             if not text.strip():
                 continue
 
-            panel = detect_panel_page(text)
+            profile = profiles.select(text)
+            regions = detect_panel_regions(text, profile)
             recepcion = parse_recepcion_datetime(text)
 
             # Cultivo: generar placeholders específicos desde la Recepción de esta página
-            if panel == "cultivo" and recepcion:
+            if recepcion and any(p == "cultivo" for _, p in regions):
+                panel = "cultivo"
                 rows.append({
                     "std": "fechacul",
                     "nombre": "Fecha Recepción Cultivo",
@@ -396,8 +809,13 @@ def parse_pdf(file_bytes: bytes):
                     "page_index": page_index
                 })
 
-            # Recorrer líneas de la página
-            for raw in text.splitlines():
+            # Recorrer líneas de la página; pdfplumber separa líneas con "\n"
+            region = 0
+            panel = regions[0][1]
+            for line_no, raw in enumerate(text.split("\n")):
+                while region + 1 < len(regions) and regions[region + 1][0] <= line_no:
+                    region += 1
+                    panel = regions[region][1]
                 line = raw.strip()
                 if not line:
                     continue
@@ -416,7 +834,7 @@ def parse_pdf(file_bytes: bytes):
                 # Valor: intenta extraer número al inicio si corresponde
                 numeric_candidate = extract_numeric_head(value)
                 # Coalesce alias con prioridad de panel
-                std = coalesce_alias(name, panel)
+                std = coalesce_alias(name, panel, profile)
 
                 # Formato según estándar
                 value_fmt = format_value(std, numeric_candidate if numeric_candidate else value)
@@ -430,17 +848,35 @@ def parse_pdf(file_bytes: bytes):
                     "page_index": page_index
                 })
 
-    return rows
+    return {"rows": rows, "skipped_pages": skipped_pages, "pages": len(pages),
+            "profiles_version": profiles.version}
+
+def parse_pdf_measured(pdf_path: str, deadline: float | None = None, cancel_path: str | None = None,
+                       profiles_version: str | None = None):
+    """parse_pdf para el pool de procesos: agrega el pico de RSS del worker."""
+    with RssSampler() as rss:
+        res = parse_pdf(pdf_path, deadline, cancel_path, profiles_version)
+    res["worker_peak_rss"] = rss.peak
+    return res
 
 # -----------------------
 # DOCX y endpoints
 # -----------------------
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "flujograma_template.docx")
+
 def render_docx(ctx: dict) -> bytes:
-    from pathlib import Path
-    BASE_DIR = Path(__file__).resolve().parent
-    template_path = str(BASE_DIR / "flujograma_template.docx")
+    template_path = TEMPLATE_PATH
     if not os.path.exists(template_path):
         raise HTTPException(500, f"Falta flujograma_template.docx en {template_path}")
+    if RENDER_ENGINE == "fast":
+        compiled = get_compiled_template()
+        if compiled is not None:
+            docx_bytes = compiled.render(ctx)
+            if docx_bytes is not None:
+                return docx_bytes
+    return render_docx_docxtpl(ctx, template_path)
+
+def render_docx_docxtpl(ctx: dict, template_path: str = TEMPLATE_PATH) -> bytes:
     doc = DocxTemplate(template_path)
     doc.render(ctx)
     with tempfile.NamedTemporaryFile(suffix=".docx", delete=False) as tmp:
@@ -451,28 +887,433 @@ def render_docx(ctx: dict) -> bytes:
     os.remove(tmp_path)
     return docx_bytes
 
+# -----------------------
+# Plantilla precompilada
+# -----------------------
+# Caracteres de uso privado: no aparecen en la plantilla y sobreviven a docxtpl/lxml intactos
+_SLOT_RE = re.compile("\ue000(\\d+)\ue001")
+_SIMPLE_VAR_RE = re.compile(r"{{\s*(\w+)\s*}}")
+_XML_ESCAPES = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+# Valores que docxtpl transforma en XML (tabs, saltos): esos renders se dejan a docxtpl
+_LISTING_CHARS = re.compile("[\t\a\n\f\r]")
+_OPEN_TAG_END_RE = re.compile(rb"<([\w:]+)(?:\s[^<>]*)?>$")
+
+class CompiledTemplate:
+    """
+    La plantilla es una grilla fija de {{ var }} sin loops ni condicionales, así que se
+    renderiza una sola vez con docxtpl usando marcadores en lugar de valores. Las partes
+    que contienen marcadores quedan como fragmentos estáticos + slots; las demás se guardan
+    ya comprimidas en un zip base al que solo se le agregan las partes renderizadas.
+    Un slot que es todo el texto de un elemento guarda su tag de cierre: vacío, lxml lo
+    serializa autocerrado (<w:t/>) y así se reproduce.
+    Diferencia intencional con docxtpl: los valores con &, < o > (p. ej. "<0,5",
+    "E. coli & ...") se escapan y quedan tal cual en el documento; docxtpl no los escapa
+    y los mutila ("E. coli & K<1>" -> "E. coli  K1>").
+    """
+    def __init__(self, template_path: str):
+        doc = DocxTemplate(template_path)
+        doc.init_docx()
+        body = doc.patch_xml(doc.get_xml())
+        if "{%" in body or "{#" in body:
+            raise ValueError("la plantilla usa bloques Jinja")
+        if body.count("{{") != len(_SIMPLE_VAR_RE.findall(body)):
+            raise ValueError("la plantilla usa expresiones Jinja no triviales")
+
+        self.names = sorted(set(_SIMPLE_VAR_RE.findall(body)))
+        markers = {name: f"\ue000{i}\ue001" for i, name in enumerate(self.names)}
+        rendered = render_docx_docxtpl(markers, template_path)
+
+        # parte -> (fragmentos, slots): fragmentos[0] + slots[0] + fragmentos[1] + ...
+        # con slot = (variable, tag de cierre si el slot es todo el texto del elemento)
+        self.parts: dict[str, tuple[list[bytes], list[tuple[str, bytes | None]]]] = {}
+        base = io.BytesIO()
+        with zipfile.ZipFile(io.BytesIO(rendered)) as src, \
+                zipfile.ZipFile(base, "w", zipfile.ZIP_DEFLATED) as dst:
+            for info in src.infolist():
+                data = src.read(info)
+                text = data.decode("utf-8", errors="ignore")
+                if "\ue000" not in text:
+                    dst.writestr(info, data, compress_type=zipfile.ZIP_DEFLATED)
+                    continue
+                pieces = _SLOT_RE.split(text)
+                fragments = [p.encode("utf-8") for p in pieces[0::2]]
+                slots = []
+                for i, idx in enumerate(pieces[1::2]):
+                    close = None
+                    m = _OPEN_TAG_END_RE.search(fragments[i])
+                    if m and fragments[i + 1].startswith(b"</" + m.group(1) + b">"):
+                        close = b"</" + m.group(1) + b">"
+                    slots.append((self.names[int(idx)], close))
+                for i, (_, close) in enumerate(slots):
+                    if close is not None:
+                        fragments[i] = fragments[i][:-1]
+                        fragments[i + 1] = fragments[i + 1][len(close):]
+                self.parts[info.filename] = (fragments, slots)
+        self.base_zip = base.getvalue()
+
+    def render(self, ctx: dict) -> bytes | None:
+        """DOCX con los valores de ctx; None si algún valor necesita el tratamiento de docxtpl."""
+        values = {}
+        for name in self.names:
+            value = ctx.get(name)
+            value = "" if value is None else str(value)
+            if _LISTING_CHARS.search(value):
+                return None
+            values[name] = value.translate(_XML_ESCAPES).encode("utf-8")
+
+        buf = io.BytesIO()
+        buf.write(self.base_zip)
+        with zipfile.ZipFile(buf, "a", zipfile.ZIP_DEFLATED) as zf:
+            for partname, (fragments, slots) in self.parts.items():
+                out = [fragments[0]]
+                for (name, close), fragment in zip(slots, fragments[1:]):
+                    value = values[name]
+                    if close is None:
+                        out.append(value)
+                    elif value:
+                        out += (b">", value, close)
+                    else:
+                        out.append(b"/>")
+                    out.append(fragment)
+                zf.writestr(zipfile.ZipInfo(partname), b"".join(out), compress_type=zipfile.ZIP_DEFLATED)
+        return buf.getvalue()
+
+def docx_parts(docx_bytes: bytes) -> dict[str, bytes]:
+    with zipfile.ZipFile(io.BytesIO(docx_bytes)) as zf:
+        return {name: zf.read(name) for name in zf.namelist()}
+
+def verify_compiled_template(compiled: CompiledTemplate, template_path: str = TEMPLATE_PATH) -> bool:
+    """
+    Renderiza un contexto de prueba con ambos motores y exige las mismas partes, byte a byte.
+    Un valor con &, < y > no se compara con docxtpl (que lo mutila): se exige XML válido
+    y que el valor aparezca literal en el texto del documento.
+    """
+    ctx = {name: f"{name} {i},5" for i, name in enumerate(compiled.names)}
+    ctx[compiled.names[0]] = ""
+    if docx_parts(compiled.render(ctx)) != docx_parts(render_docx_docxtpl(ctx, template_path)):
+        return False
+
+    special = "E. coli & K<1> <0,5"
+    parts = docx_parts(compiled.render({**ctx, compiled.names[-1]: special}))
+    texts = ["".join(ElementTree.fromstring(parts[name]).itertext()) for name in compiled.parts]
+    return any(special in text for text in texts)
+
+_compiled_template: CompiledTemplate | None = None
+_compiled_template_failed = False
+_compile_lock = threading.Lock()
+
+def get_compiled_template() -> CompiledTemplate | None:
+    """Compila y verifica la plantilla una vez por proceso; None si hay que usar docxtpl."""
+    global _compiled_template, _compiled_template_failed
+    if _compiled_template is not None or _compiled_template_failed:
+        return _compiled_template
+    with _compile_lock:
+        if _compiled_template is None and not _compiled_template_failed:
+            try:
+                compiled = CompiledTemplate(TEMPLATE_PATH)
+                if not verify_compiled_template(compiled):
+                    raise ValueError("el render precompilado no coincide con docxtpl")
+                _compiled_template = compiled
+            except Exception as exc:
+                logger.warning("Plantilla precompilada desactivada, se usa docxtpl: %s", exc)
+                _compiled_template_failed = True
+    return _compiled_template
+
+# -----------------------
+# Cache de resultados (DOCX) con ETag
+# -----------------------
+class ResultCache:
+    """LRU acotada por bytes totales y TTL; guarda (etag, docx_bytes) por clave de entrada."""
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, str, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> tuple[str, bytes] | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def put(self, key: str, etag: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic(), etag, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: str):
+        _, _, data = self._entries.pop(key)
+        self.size -= len(data)
+
+RESULT_CACHE = ResultCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL_S)
+
+_template_digest: str | None = None
+
+def template_digest() -> str:
+    global _template_digest
+    if _template_digest is None:
+        with open(TEMPLATE_PATH, "rb") as f:
+            _template_digest = hashlib.sha256(f.read()).hexdigest()
+    return _template_digest
+
+def result_key(pdf_digests: list[str], profiles_version: str) -> str:
+    """
+    Clave de cache: hashes de los PDFs (sin importar el orden) + plantilla + versión del
+    parser + versión de los perfiles de alias. Antes de parsear es la versión vigente en
+    este proceso; el resultado se guarda con la que usaron los workers (parse_pdfs).
+    """
+    h = hashlib.sha256()
+    h.update(f"{PARSER_VERSION}\n{template_digest()}\n{profiles_version}\n".encode())
+    for digest in sorted(pdf_digests):
+        h.update(digest.encode())
+    return h.hexdigest()
+
+def result_etag(key: str, skipped: list[dict] | None = None) -> str:
+    """
+    ETag derivado de la clave de entrada y no de los bytes del DOCX: el mismo input da el
+    mismo ETag en cualquier worker o después de reiniciar, y se puede responder 304 sin
+    parsear. Es débil (W/) porque los bytes no son idénticos entre procesos (fechas del zip,
+    render con docxtpl). Un resultado parcial lleva además las páginas omitidas.
+    """
+    if skipped:
+        key = hashlib.sha256(f"{key}\n{json.dumps(skipped, sort_keys=True)}".encode()).hexdigest()
+    return 'W/"' + key + '"'
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag.removeprefix("W/"):
+            return True
+    return False
+
 @app.get("/health")
 def health():
-    return {"ok": True}
+    return {"ok": True, "alias_profiles": get_alias_profiles().version}
+
+@app.get("/metrics")
+def metrics():
+    with _metrics_lock:
+        return dict(
+            METRICS,
+            rss=current_rss(),
+            result_cache_hits=RESULT_CACHE.hits,
+            result_cache_misses=RESULT_CACHE.misses,
+            result_cache_bytes=RESULT_CACHE.size,
+        )
+
+def _spool_copy(src, spool_dir: str) -> tuple[str, str] | None:
+    """
+    Copia un stream al spool por bloques, calculando su sha256 en la misma pasada.
+    Retorna (ruta, digest), o None si venía vacío. Si la copia falla no deja el archivo a medias.
+    """
+    fd, path = tempfile.mkstemp(suffix=".pdf", dir=spool_dir)
+    h = hashlib.sha256()
+    try:
+        with os.fdopen(fd, "wb") as dst:
+            while chunk := src.read(SPOOL_CHUNK):
+                h.update(chunk)
+                dst.write(chunk)
+            size = dst.tell()
+    except BaseException:
+        os.remove(path)
+        raise
+    if size == 0:
+        os.remove(path)
+        return None
+    return path, h.hexdigest()
 
-def extract_pdfs_from_uploads(files: list[UploadFile]) -> list[bytes]:
-    import zipfile
-    pdf_bytes_list = []
+class RequestSpool:
+    """
+    Directorio temporal de un request en SPOOL_DIR (path). /dev/shm suele ser chico (64 MB
+    en Docker) y ocupa RAM: si se llena, el PDF que falló y los siguientes se escriben en
+    un directorio de respaldo en el disco. Al salir se borran ambos.
+    """
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix="labflux-", dir=SPOOL_DIR)
+        self.fallback: str | None = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        for path in (self.path, self.fallback):
+            if path:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def copy(self, src) -> tuple[str, str] | None:
+        """_spool_copy al spool vigente, pasando al disco ante ENOSPC."""
+        try:
+            return _spool_copy(src, self.fallback or self.path)
+        except OSError as exc:
+            if exc.errno != errno.ENOSPC or self.fallback is not None or not src.seekable():
+                raise
+        self.fallback = tempfile.mkdtemp(prefix="labflux-", dir=tempfile.gettempdir())
+        logger.warning("Spool %s lleno, se sigue en %s", SPOOL_DIR, self.fallback)
+        src.seek(0)
+        return _spool_copy(src, self.fallback)
+
+def extract_pdfs_from_uploads(files: list[UploadFile], spool: RequestSpool) -> list[tuple[str, str]]:
+    """
+    Escribe cada PDF (suelto o dentro de un ZIP) una sola vez en el spool y retorna
+    [(ruta, sha256)]. Los uploads se leen directo del SpooledTemporaryFile de Starlette,
+    sin pasar por bytes.
+    """
+    pdf_paths = []
     for uf in files:
-        content = uf.file.read() if hasattr(uf, "file") else None
-        if content is None or len(content) == 0:
+        src = getattr(uf, "file", None)
+        if src is None:
             continue
         filename = (uf.filename or "").lower()
         if filename.endswith(".zip"):
-            with io.BytesIO(content) as bio:
-                with zipfile.ZipFile(bio) as zf:
-                    for name in zf.namelist():
-                        if name.lower().endswith(".pdf"):
-                            with zf.open(name) as zpdf:
-                                pdf_bytes_list.append(zpdf.read())
+            src.seek(0, os.SEEK_END)
+            if src.tell() == 0:
+                continue
+            src.seek(0)
+            with zipfile.ZipFile(src) as zf:
+                for name in zf.namelist():
+                    if name.lower().endswith(".pdf"):
+                        with zf.open(name) as zpdf:
+                            spooled = spool.copy(zpdf)
+                        if spooled:
+                            pdf_paths.append(spooled)
         elif filename.endswith(".pdf"):
-            pdf_bytes_list.append(content)
-    return pdf_bytes_list
+            src.seek(0)
+            spooled = spool.copy(src)
+            if spooled:
+                pdf_paths.append(spooled)
+    return pdf_paths
+
+_parse_pool: ProcessPoolExecutor | None = None
+_parse_threads: ThreadPoolExecutor | None = None
+
+def _init_parse_worker():
+    # Los workers heredan los handlers de señales de uvicorn (que nunca correrían acá):
+    # SIGTERM vuelve al default y SIGINT lo maneja el proceso padre.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def get_parse_pool() -> ProcessPoolExecutor | None:
+    """Pool de procesos para parse_pdf (lazy); None si PARSE_WORKERS=0."""
+    global _parse_pool
+    if PARSE_WORKERS > 0 and _parse_pool is None:
+        _parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS, initializer=_init_parse_worker)
+    return _parse_pool
+
+def get_parse_threads() -> ThreadPoolExecutor:
+    """
+    Threads para parse_pdf con PARSE_WORKERS=0. Es un pool propio y no el del loop: se le
+    envían las tareas directamente para poder cancelar las que aún no parten.
+    """
+    global _parse_threads
+    if _parse_threads is None:
+        _parse_threads = ThreadPoolExecutor(thread_name_prefix="parse")
+    return _parse_threads
+
+class RequestAborted(Exception):
+    """El cliente cerró la conexión; no vale la pena seguir trabajando."""
+
+class RequestGuard:
+    """
+    Plazo y desconexión de un request. Los workers solo ven (deadline, cancel_path):
+    cancelar = crear el archivo de cancelación en el spool del request.
+    """
+    def __init__(self, request: Request, spool_dir: str):
+        self.request = request
+        self.deadline = time.monotonic() + REQUEST_DEADLINE_S if REQUEST_DEADLINE_S > 0 else None
+        self.cancel_path = os.path.join(spool_dir, ".cancel")
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def cancel(self):
+        open(self.cancel_path, "w").close()
+
+    async def disconnected(self) -> bool:
+        if os.path.exists(self.cancel_path):
+            return True
+        if await self.request.is_disconnected():
+            self.cancel()
+            return True
+        return False
+
+    async def checkpoint(self, deadline: bool = False):
+        """
+        Punto de control entre etapas: aborta si el cliente ya no está y, con deadline=True,
+        responde 504 si ya venció el plazo.
+        """
+        if await self.disconnected():
+            raise RequestAborted()
+        if deadline and self.expired():
+            raise HTTPException(504, "Tiempo límite excedido al procesar los PDFs.")
+
+    async def watch(self, futures):
+        """
+        Si el cliente se va, marca la cancelación (los parseos en curso la ven entre páginas)
+        y cancela los concurrent.futures que aún no parten; cancel() no afecta a los que corren.
+        """
+        while True:
+            await asyncio.sleep(DISCONNECT_POLL_S)
+            if await self.disconnected():
+                for fut in futures:
+                    fut.cancel()
+                return
+
+async def parse_pdfs(pdf_paths: list[str], guard: RequestGuard, stats: dict,
+                     profiles_version: str) -> tuple[list[dict], list[dict], str]:
+    """
+    Parsea los PDFs del spool en paralelo; a los workers solo viajan rutas.
+    Retorna (filas, páginas omitidas por plazo como [{"pdf_index", "pages"}], versión de
+    perfiles usada) y completa stats. Los workers recargan sus perfiles si no tienen
+    profiles_version; si aun así alguno parseó con otra, la versión usada las lista todas
+    ("a+b") y el resultado se guarda con esa clave, no con la de profiles_version.
+    Ante una desconexión espera a que los parseos en curso se detengan antes de abortar:
+    el spool (con el archivo de cancelación) se borra recién al salir del request.
+    """
+    pool = get_parse_pool()
+    parse_fn = parse_pdf_measured if pool else parse_pdf
+    futures = [
+        (pool or get_parse_threads()).submit(parse_fn, path, guard.deadline, guard.cancel_path,
+                                             profiles_version)
+        for path in pdf_paths
+    ]
+    watcher = asyncio.create_task(guard.watch(futures))
+    try:
+        results = await asyncio.gather(*map(asyncio.wrap_future, futures), return_exceptions=True)
+    finally:
+        watcher.cancel()
+    await guard.checkpoint()
+
+    all_rows, skipped, versions = [], [], set()
+    for pdf_index, res in enumerate(results):
+        if isinstance(res, PageLimitExceeded):
+            raise HTTPException(413, f"El PDF tiene {res.args[0]} páginas (máximo {MAX_PDF_PAGES}).")
+        if isinstance(res, BaseException):
+            raise res
+        stats["pdfs"] += 1
+        stats["pages"] += res["pages"]
+        stats["worker_peak_rss"] = max(stats["worker_peak_rss"], res.get("worker_peak_rss", 0))
+        all_rows.extend(res["rows"])
+        versions.add(res["profiles_version"])
+        if res["skipped_pages"]:
+            skipped.append({"pdf_index": pdf_index, "pages": res["skipped_pages"]})
+    return all_rows, skipped, "+".join(sorted(versions))
 
 def build_context(all_rows):
     """
@@ -776,26 +1617,55 @@ def index():
 </html>
 """
 
+def aborted_response():
+    # 499 (convención nginx): el cliente cerró la conexión antes de la respuesta
+    return PlainTextResponse("Client Closed Request", status_code=499)
+
 @app.post("/generate")
-async def generate(files: list[UploadFile] = File(...)):
+async def generate(request: Request, files: list[UploadFile] = File(...)):
     if not files:
         raise HTTPException(400, "Sube al menos un PDF.")
 
-    pdf_bytes_list = extract_pdfs_from_uploads(files)
-    if not pdf_bytes_list:
-        raise HTTPException(400, "No se encontraron PDFs válidos.")
-
-    all_rows = []
-    for content in pdf_bytes_list:
-        all_rows.extend(parse_pdf(content))
-
-    ctx = build_context(all_rows)
-    docx_bytes = render_docx(ctx)
+    try:
+        with track_request("generate") as stats, \
+                RequestSpool() as spool:
+            guard = RequestGuard(request, spool.path)
+            pdf_files = extract_pdfs_from_uploads(files, spool)
+            if not pdf_files:
+                raise HTTPException(400, "No se encontraron PDFs válidos.")
+
+            digests = [digest for _, digest in pdf_files]
+            profiles_version = get_alias_profiles().version
+            key = result_key(digests, profiles_version)
+            if etag_matches(request.headers.get("if-none-match"), result_etag(key)):
+                return Response(status_code=304, headers={"ETag": result_etag(key)})
+            cached = RESULT_CACHE.get(key)
+            if cached:
+                etag, docx_bytes = cached
+            else:
+                all_rows, skipped, used_version = await parse_pdfs(
+                    [path for path, _ in pdf_files], guard, stats, profiles_version)
+                if used_version != profiles_version:
+                    key = result_key(digests, used_version)
+                if skipped:
+                    raise HTTPException(504, "Tiempo límite excedido al procesar los PDFs.")
+
+                ctx = build_context(all_rows)
+                await guard.checkpoint(deadline=True)
+                docx_bytes = render_docx(ctx)
+                etag = result_etag(key)
+                RESULT_CACHE.put(key, etag, docx_bytes)
+    except RequestAborted:
+        return aborted_response()
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
 
     headers = {
         "Content-Disposition": 'attachment; filename="LabFluxHPH.docx"',
         "Content-Length": str(len(docx_bytes)),
         "Cache-Control": "no-cache",
+        "ETag": etag,
     }
 
     return StreamingResponse(
@@ -806,39 +1676,76 @@ async def generate(files: list[UploadFile] = File(...)):
 
 
 @app.post("/generate_json")
-async def generate_json(files: list[UploadFile] = File(...), debug: int = 0):
+async def generate_json(request: Request, files: list[UploadFile] = File(...), debug: int = 0, partial: int = 1):
     """
     Si debug=1 -> devuelve filas parseadas y contexto (sin DOCX).
     Si debug=0 -> devuelve el DOCX en base64 (uso normal).
+    Si vence el plazo y partial=1 -> resultado parcial; 'skipped_pages' lista lo no procesado.
+    Los resultados completos se cachean; con If-None-Match igual al ETag responde 304 antes
+    de parsear.
     """
     if not files:
         raise HTTPException(400, "Sube al menos un PDF.")
 
-    all_rows = []
-    pdf_bytes_list = extract_pdfs_from_uploads(files)
-    if not pdf_bytes_list:
-        raise HTTPException(400, "No se encontraron PDFs válidos.")
-    for content in pdf_bytes_list:
-        all_rows.extend(parse_pdf(content))
-
-    ctx = build_context(all_rows)
-    if debug:
-        # debug enriquecido con page_index y panel
-        return {
-            "debug": 1,
-            "rows": all_rows,
-            "ctx": ctx,
-            "notes": "OK (solo debug, sin DOCX)"
-        }
+    try:
+        with track_request("generate_json") as stats, \
+                RequestSpool() as spool:
+            guard = RequestGuard(request, spool.path)
+            pdf_files = extract_pdfs_from_uploads(files, spool)
+            if not pdf_files:
+                raise HTTPException(400, "No se encontraron PDFs válidos.")
+
+            digests = [digest for _, digest in pdf_files]
+            profiles_version = get_alias_profiles().version
+            key = result_key(digests, profiles_version)
+            if not debug and etag_matches(request.headers.get("if-none-match"), result_etag(key)):
+                return Response(status_code=304, headers={"ETag": result_etag(key)})
+            cached = None if debug else RESULT_CACHE.get(key)
+            if cached:
+                etag, docx_bytes = cached
+                skipped, status = [], "OK"
+            else:
+                all_rows, skipped, used_version = await parse_pdfs(
+                    [path for path, _ in pdf_files], guard, stats, profiles_version)
+                if used_version != profiles_version:
+                    key = result_key(digests, used_version)
+                if skipped and not partial:
+                    raise HTTPException(504, "Tiempo límite excedido al procesar los PDFs.")
+                status = "PARCIAL (tiempo límite excedido)" if skipped else "OK"
+
+                ctx = build_context(all_rows)
+                if debug:
+                    # debug enriquecido con page_index y panel
+                    return {
+                        "debug": 1,
+                        "rows": all_rows,
+                        "ctx": ctx,
+                        "skipped_pages": skipped,
+                        "notes": f"{status} (solo debug, sin DOCX)"
+                    }
+
+                # con partial=1 se entrega lo parseado aunque el plazo venza antes de renderizar
+                await guard.checkpoint(deadline=not partial)
+                docx_bytes = render_docx(ctx)
+                etag = result_etag(key, skipped)
+                if not skipped:
+                    # un resultado parcial no se cachea
+                    RESULT_CACHE.put(key, etag, docx_bytes)
+    except RequestAborted:
+        return aborted_response()
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
 
-    docx_bytes = render_docx(ctx)
     data_b64 = base64.b64encode(docx_bytes).decode("ascii")
-    return {
+    return JSONResponse({
         "filename": "LabFluxHPH.docx",
         "mime": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
         "data_base64": data_b64,
-        "notes": "OK (DOCX)"
-    }
+        "etag": etag,
+        "skipped_pages": skipped,
+        "notes": f"{status} (DOCX)"
+    }, headers={"ETag": etag})
 
 
 if __name__ == "__main__":